@@ -1,283 +1,654 @@
 import argparse
+import collections
+import contextlib
 import csv
+import itertools
 import json
+import logging
+import random
+import re
+import sqlite3
+import sys
+import threading
 import time
-from typing import Any, Dict, List
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, as_completed, wait
+from operator import itemgetter
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 import config
 
+try:
+    import orjson
+except ImportError:  # orjsonが無い環境では標準のjsonを使う
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+# Notion APIのレート制限(平均3リクエスト/秒)に合わせた並列度
+NOTION_REQUESTS_PER_SECOND = 3
+MAX_WORKERS = 3
+# 同時に保持する未完了タスク数の上限 (CSVの先読み量を抑える)
+MAX_PENDING = MAX_WORKERS * 2
+# 登録・更新の進捗を出力する間隔 (行数)
+PROGRESS_INTERVAL = 100
+# 1リクエストあたりのタイムアウト秒数 (接続, 応答待ち)。応答しないソケットでワーカーが止まらないようにする
+REQUEST_TIMEOUT = (10, 60)
+
+# CSVの行数がこれ以下なら、DB全件ではなく複合キーで絞り込んだクエリでページを取得する
+TARGETED_QUERY_MAX_ROWS = 200
+# 1回のクエリに含めるフィルタ条件数の上限
+NOTION_FILTER_MAX_CONDITIONS = 100
+
+# 全API呼び出しで1つのセッションを共有し、keep-aliveでTCP/TLS接続を再利用する。
+# アダプタでは接続エラーだけをリトライする。429/5xxのリトライはレート制限を通すため
+# _request_with_backoffだけで行い、ここではステータスコードによるリトライをしない
+_SESSION = requests.Session()
+_SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=16,
+        max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=()),
+    ),
+)
+_SESSION.headers.update(
+    {
+        "Authorization": f"Bearer {config.NOTION_API_KEY}",
+        "Notion-Version": config.NOTION_API_VERSION,
+        "Content-Type": "application/json",
+    }
+)
+
+
+class _RateLimiter:
+    """直近 per 秒間のリクエスト数を rate 以下に抑えるスロットル (スレッドセーフ)"""
+
+    def __init__(self, rate: int, per: float = 1.0):
+        self._per = per
+        self._timestamps = collections.deque(maxlen=rate)
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            if len(self._timestamps) == self._timestamps.maxlen:
+                delay = self._timestamps[0] + self._per - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            self._timestamps.append(time.monotonic())
+
+
+_RATE_LIMITER = _RateLimiter(NOTION_REQUESTS_PER_SECOND)
+
+
+class NotionAPIError(Exception):
+    """Notion APIがエラーを返した、通信に失敗した、またはリトライ上限に達した場合に送出する"""
+
+    def __init__(self, message: str, response: Optional[requests.Response] = None):
+        super().__init__(message)
+        self.response = response
+
+
+def _json_dumps(obj: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj).encode("utf-8")
+
+
+def _json_loads(data: bytes) -> Any:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _request_with_backoff(
+    method: str,
+    url: str,
+    max_retries: int = 6,
+    base: float = 1.0,
+    cap: float = 32.0,
+    idempotent: bool = True,
+    **kwargs: Any,
+) -> requests.Response:
+    """429・5xx・通信エラーをリトライしつつNotion APIを呼び出す。
+
+    429はRetry-Afterの秒数、それ以外は上限付き指数バックオフだけ待ち、
+    どちらにも同時リトライが重ならないようジッタを加える。
+    idempotent=False (ページ作成) の場合、サーバー側で処理済みかもしれない
+    5xxと送信後の通信エラーはリトライせず、二重登録を避ける。
+    """
+    if "json" in kwargs:
+        # リトライのたびに再シリアライズしないよう、送信前に一度だけbytesにする
+        kwargs["data"] = _json_dumps(kwargs.pop("json"))
+    kwargs.setdefault("timeout", REQUEST_TIMEOUT)
+    for attempt in range(max_retries + 1):
+        _RATE_LIMITER.acquire()
+        try:
+            resp = _SESSION.request(method, url, **kwargs)
+        except requests.RequestException as e:
+            # 接続できなかった場合はリクエストが届いていないので、ページ作成でもリトライしてよい
+            if (not idempotent and not isinstance(e, requests.ConnectTimeout)) or attempt == max_retries:
+                raise NotionAPIError(f"{type(e).__name__}: {e}") from e
+            delay = min(cap, base * 2**attempt)
+            logger.warning("[WARN] Request failed (%s). Retrying after %g seconds.", type(e).__name__, delay)
+            time.sleep(delay + random.uniform(0, 0.5))
+            continue
+        retryable = resp.status_code == 429 or (idempotent and resp.status_code >= 500)
+        if not retryable:
+            if not resp.ok:
+                raise NotionAPIError(resp.text, resp)
+            return resp
+        if attempt == max_retries:
+            break
+        backoff = min(cap, base * 2**attempt)
+        if resp.status_code == 429:
+            delay = float(resp.headers.get("Retry-After", backoff))
+            logger.warning("[WARN] Rate limited. Retrying after %g seconds.", delay)
+        else:
+            delay = backoff
+            logger.warning("[WARN] Server error %s. Retrying after %g seconds.", resp.status_code, delay)
+        time.sleep(delay + random.uniform(0, 0.5))
+    raise NotionAPIError(resp.text, resp)
+
+
+# 複合キーは各列の値のタプル (結合文字列を作らずにハッシュでき、値に"::"を含んでも衝突しない)
+CompositeKey = Tuple[str, ...]
+# 複合キー -> Notionのページ
+NotionPageIndex = Dict[CompositeKey, Dict[str, Any]]
 
-def load_csv(csv_path: str, composite_keys: List[str]) -> List[Dict[str, Any]]:
-    rows = []
+
+def _check_csv_duplicate_keys(csv_path: str, composite_keys: List[str]):
+    # 登録を始める前にCSV全体の複合キーだけを読み、重複があれば1件もリクエストせずに中断する
     composite_keys_set = set()
     with open(csv_path, encoding="utf-8") as f:
-        reader = csv.DictReader(f)
+        reader = csv.DictReader(f, restval="")
+        get_key = make_composite_key_getter(composite_keys)
         for row in reader:
-            composite_key = extract_composite_key(row, composite_keys)
-            if composite_key in composite_keys_set:
-                raise ValueError(f"CSVファイルに重複する複合キーが存在します: {composite_key}")
+            composite_key = get_key(row)
+            # in判定とaddで2回ハッシュしないよう、addの前後で件数が増えたかどうかで重複を判定する
+            seen = len(composite_keys_set)
             composite_keys_set.add(composite_key)
-            rows.append(row)
-    return rows
+            if len(composite_keys_set) == seen:
+                raise ValueError(f"CSVファイルに重複する複合キーが存在します: {format_composite_key(composite_key)}")
+
+
+def _iter_csv_rows(csv_path: str) -> Iterator[Dict[str, Any]]:
+    with open(csv_path, encoding="utf-8") as f:
+        yield from csv.DictReader(f, restval="")
 
 
-def get_notion_db_items(mapping: Dict[str, Any], composite_keys: List[str]) -> List[Dict[str, Any]]:
+def load_csv(csv_path: str, composite_keys: List[str]) -> Iterator[Dict[str, Any]]:
+    # 巨大なCSVでもメモリに全行を載せないよう、重複チェックの後にもう一度先頭から1行ずつ読む
+    _check_csv_duplicate_keys(csv_path, composite_keys)
+    return _iter_csv_rows(csv_path)
+
+
+def _query_notion_db(filter_: Optional[Dict[str, Any]] = None) -> Iterator[Dict[str, Any]]:
     url = f"{config.NOTION_API_URL}/databases/{config.NOTION_DATABASE_ID}/query"
-    headers = {
-        "Authorization": f"Bearer {config.NOTION_API_KEY}",
-        "Notion-Version": config.NOTION_API_VERSION,
-        "Content-Type": "application/json",
-    }
-    results = []
-    composite_keys_set = set()
-    has_more = True
-    next_cursor = None
-    while has_more:
+
+    def fetch(cursor: Optional[str]) -> Dict[str, Any]:
         payload = {"page_size": 100}
-        if next_cursor:
-            payload["start_cursor"] = next_cursor
-        resp = requests.post(url, headers=headers, json=payload)
-        resp.raise_for_status()
-        data = resp.json()
-        for page in data.get("results", []):
-            composite_key = extract_notion_composite_key(page, mapping, composite_keys)
-            if composite_key in composite_keys_set:
-                raise ValueError(f"Notionデータベースに重複する複合キーが存在します: {composite_key}")
-            composite_keys_set.add(composite_key)
-            results.append(page)
-        has_more = data.get("has_more", False)
-        next_cursor = data.get("next_cursor")
+        if filter_:
+            payload["filter"] = filter_
+        if cursor:
+            payload["start_cursor"] = cursor
+        return _json_loads(_request_with_backoff("POST", url, json=payload).content)
+
+    # 次のページの取得をバックグラウンドで先に始め、呼び出し側の処理と通信待ちを重ねる
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        data = fetch(None)
+        while True:
+            next_future = executor.submit(fetch, data.get("next_cursor")) if data.get("has_more") else None
+            yield from data.get("results", [])
+            if next_future is None:
+                break
+            data = next_future.result()
+
+
+def _collect_notion_pages(
+    pages: Iterable[Dict[str, Any]], mapping: Dict[str, Any], composite_keys: List[str]
+) -> NotionPageIndex:
+    # 重複チェックと索引作りを1回の複合キー算出で済ませる
+    resolved_keys = resolve_notion_composite_keys(mapping, composite_keys)
+    pages_by_key = {}
+    for page in pages:
+        composite_key = notion_composite_key(page, resolved_keys)
+        if pages_by_key.setdefault(composite_key, page) is not page:
+            raise ValueError(f"Notionデータベースに重複する複合キーが存在します: {format_composite_key(composite_key)}")
+    return pages_by_key
+
+
+def get_notion_db_items(mapping: Dict[str, Any], composite_keys: List[str]) -> NotionPageIndex:
+    return _collect_notion_pages(_query_notion_db(), mapping, composite_keys)
+
+
+def get_notion_db_items_cached(cache_path: str, mapping: Dict[str, Any], composite_keys: List[str]) -> NotionPageIndex:
+    """前回同期以降に編集されたページだけをNotionから取得し、SQLiteのキャッシュと合わせて全ページを返す。
+
+    キャッシュが空なら全件を取得する。Notion側で削除したページはキャッシュに残るため、
+    その場合はキャッシュファイルを削除して取り直すこと。
+    """
+    db_id = config.NOTION_DATABASE_ID
+    with contextlib.closing(sqlite3.connect(cache_path)) as conn:
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS notion_pages ("
+            "db_id TEXT NOT NULL, page_id TEXT NOT NULL, last_edited_time TEXT NOT NULL, page BLOB NOT NULL, "
+            "PRIMARY KEY (db_id, page_id))"
+        )
+        (last_synced,) = conn.execute(
+            "SELECT MAX(last_edited_time) FROM notion_pages WHERE db_id = ?", (db_id,)
+        ).fetchone()
+        filter_ = None
+        if last_synced:
+            # last_edited_timeは分単位に丸められるため、同時刻のページも取り直す
+            filter_ = {"timestamp": "last_edited_time", "last_edited_time": {"on_or_after": last_synced}}
+        with conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO notion_pages (db_id, page_id, last_edited_time, page) VALUES (?, ?, ?, ?)",
+                (
+                    (db_id, page["id"], page["last_edited_time"], _json_dumps(page))
+                    for page in _query_notion_db(filter_)
+                ),
+            )
+        rows = conn.execute("SELECT page FROM notion_pages WHERE db_id = ?", (db_id,))
+        pages = [_json_loads(page) for (page,) in rows]
+    return _collect_notion_pages(pages, mapping, composite_keys)
+
+
+def can_query_by_composite_keys(mapping: Dict[str, Any], composite_keys: List[str]) -> bool:
+    return all(mapping[k]["type"] in _FILTER_PROPERTY_TYPES for k in composite_keys)
+
+
+def _composite_key_filter(row: Dict[str, Any], mapping: Dict[str, Any], composite_keys: List[str]) -> Dict[str, Any]:
+    conditions = []
+    for csv_key in composite_keys:
+        value = row[csv_key]
+        conditions.append(
+            {
+                "property": mapping[csv_key]["notion"],
+                _FILTER_PROPERTY_TYPES[mapping[csv_key]["type"]]: {"equals": value} if value else {"is_empty": True},
+            }
+        )
+    return {"and": conditions}
+
+
+def get_notion_db_items_by_keys(
+    csv_rows: List[Dict[str, Any]], mapping: Dict[str, Any], composite_keys: List[str]
+) -> NotionPageIndex:
+    """CSVの複合キーに一致するページだけをNotionのフィルタ付きクエリで取得する"""
+    rows_per_query = max(1, NOTION_FILTER_MAX_CONDITIONS // len(composite_keys))
+    pages = itertools.chain.from_iterable(
+        _query_notion_db({"or": [_composite_key_filter(row, mapping, composite_keys) for row in chunk]})
+        for chunk in (csv_rows[i : i + rows_per_query] for i in range(0, len(csv_rows), rows_per_query))
+    )
+    return _collect_notion_pages(pages, mapping, composite_keys)
 
-    return results
 
+def extract_composite_key(row: Dict[str, Any], keys: List[str]) -> CompositeKey:
+    return tuple([str(row[k]) for k in keys])
 
-def extract_composite_key(row: Dict[str, Any], keys: List[str]) -> str:
-    return "::".join([str(row[k]) for k in keys])
 
+def make_composite_key_getter(keys: List[str]) -> Callable[[Dict[str, Any]], CompositeKey]:
+    """CSV行から複合キーを取り出す関数を返す。DictReaderの値は常にstrなのでstr()は省く"""
+    get = itemgetter(*keys)
+    if len(keys) == 1:
+        return lambda row: (get(row),)
+    return get
 
-def extract_notion_composite_key(page: Dict[str, Any], mapping: Dict[str, Any], keys: List[str]) -> str:
+
+def format_composite_key(key: CompositeKey) -> str:
+    """ログ・エラーメッセージ用に複合キーを文字列にする"""
+    return "::".join(key)
+
+
+def _extract_title(prop: Dict[str, Any]) -> str:
+    return prop["title"][0]["plain_text"] if prop["title"] else ""
+
+
+def _extract_text(prop: Dict[str, Any]) -> str:
+    return prop["rich_text"][0]["plain_text"] if prop["rich_text"] else ""
+
+
+def _extract_select(prop: Dict[str, Any]) -> str:
+    return prop["select"]["name"] if prop["select"] else ""
+
+
+def _extract_multi_select(prop: Dict[str, Any]) -> str:
+    return ",".join([v["name"] for v in prop["multi_select"]]) if prop["multi_select"] else ""
+
+
+def _extract_relation(prop: Dict[str, Any]) -> str:
+    return ",".join([v["id"] for v in prop["relation"]]) if prop["relation"] else ""
+
+
+def _extract_people(prop: Dict[str, Any]) -> str:
+    return ",".join([v["id"] for v in prop["people"]]) if prop["people"] else ""
+
+
+def _extract_last_edited_by(prop: Dict[str, Any]) -> str:
+    return prop["last_edited_by"]["id"] if prop["last_edited_by"] else ""
+
+
+def _extract_last_edited_time(prop: Dict[str, Any]) -> str:
+    return prop["last_edited_time"] if prop["last_edited_time"] else ""
+
+
+def _extract_unsupported(prop: Dict[str, Any]) -> str:
+    return ""
+
+
+# マッピングの型ごとに、Notionプロパティから文字列値を取り出す関数
+_EXTRACTORS: Dict[str, Callable[[Dict[str, Any]], str]] = {
+    "title": _extract_title,
+    "text": _extract_text,
+    "select": _extract_select,
+    "multi_select": _extract_multi_select,
+    "relation": _extract_relation,
+    "people": _extract_people,
+    "last_edited_by": _extract_last_edited_by,
+    "last_edited_time": _extract_last_edited_time,
+}
+
+# 複合キーでの絞り込みクエリに使える型と、Notionフィルタでのプロパティ種別
+_FILTER_PROPERTY_TYPES = {
+    "title": "title",
+    "text": "rich_text",
+    "select": "select",
+}
+
+
+def resolve_notion_composite_keys(
+    mapping: Dict[str, Any], keys: List[str]
+) -> List[Tuple[str, Callable[[Dict[str, Any]], str]]]:
+    """複合キーの各列を (Notionプロパティ名, 抽出関数) の組に解決する"""
+    return [(mapping[k]["notion"], _EXTRACTORS.get(mapping[k]["type"], _extract_unsupported)) for k in keys]
+
+
+def notion_composite_key(
+    page: Dict[str, Any], resolved_keys: List[Tuple[str, Callable[[Dict[str, Any]], str]]]
+) -> CompositeKey:
     props = page["properties"]
-    values = []
-    for csv_key in keys:
-        notion_prop = mapping[csv_key]["notion"]
-        typ = mapping[csv_key]["type"]
-        value = ""
-        if typ == "title":
-            value = props[notion_prop]["title"][0]["plain_text"] if props[notion_prop]["title"] else ""
-        elif typ == "text":
-            value = props[notion_prop]["rich_text"][0]["plain_text"] if props[notion_prop]["rich_text"] else ""
-        elif typ == "select":
-            value = props[notion_prop]["select"]["name"] if props[notion_prop]["select"] else ""
-        elif typ == "multi_select":
-            value = (
-                ",".join([v["name"] for v in props[notion_prop]["multi_select"]])
-                if props[notion_prop]["multi_select"]
-                else ""
-            )
-        elif typ == "relation":
-            value = (
-                ",".join([v["id"] for v in props[notion_prop]["relation"]]) if props[notion_prop]["relation"] else ""
-            )
-        elif typ == "people":
-            value = ",".join([v["id"] for v in props[notion_prop]["people"]]) if props[notion_prop]["people"] else ""
-        elif typ == "last_edited_by":
-            value = props[notion_prop]["last_edited_by"]["id"] if props[notion_prop]["last_edited_by"] else ""
-        elif typ == "last_edited_time":
-            value = props[notion_prop]["last_edited_time"] if props[notion_prop]["last_edited_time"] else ""
-        values.append(value)
-    return "::".join(values)
-
-
-def are_properties_equal(csv_row: Dict[str, Any], notion_page: Dict[str, Any], mapping: Dict[str, Any]) -> bool:
-    """Compares properties of a CSV row and a Notion page based on the mapping."""
-    notion_props = notion_page["properties"]
-    for csv_col, mapinfo in mapping.items():
-        notion_prop_name = mapinfo["notion"]
-        prop_type = mapinfo["type"]
-        csv_value = csv_row[csv_col]
+    return tuple([extract(props[notion_prop]) for notion_prop, extract in resolved_keys])
+
 
+def extract_notion_composite_key(page: Dict[str, Any], mapping: Dict[str, Any], keys: List[str]) -> CompositeKey:
+    return notion_composite_key(page, resolve_notion_composite_keys(mapping, keys))
+
+
+ComparePlan = List[Tuple[str, str, Optional[Callable[[Dict[str, Any]], str]]]]
+
+
+def compile_compare_plan(mapping: Dict[str, Any]) -> ComparePlan:
+    """マッピングを比較用の (CSV列名, Notionプロパティ名, 抽出関数) のリストに変換する"""
+    return [
+        (csv_col, mapinfo["notion"], _EXTRACTORS.get(mapinfo["type"]))
+        for csv_col, mapinfo in mapping.items()
         # Skip comparison for properties that are automatically managed by Notion
-        if prop_type in ["last_edited_by", "last_edited_time"]:
-            continue
+        if mapinfo["type"] not in ["last_edited_by", "last_edited_time"]
+    ]
+
 
+def are_properties_equal(csv_row: Dict[str, Any], notion_page: Dict[str, Any], plan: ComparePlan) -> bool:
+    """Compares properties of a CSV row and a Notion page based on the compiled mapping."""
+    notion_props = notion_page["properties"]
+    for csv_col, notion_prop_name, extract in plan:
         # Get the current value from the Notion page
         notion_value = None
-        if notion_prop_name in notion_props:
-            notion_prop = notion_props[notion_prop_name]
-            if prop_type == "title":
-                notion_value = notion_prop["title"][0]["plain_text"] if notion_prop["title"] else ""
-            elif prop_type == "text":
-                notion_value = notion_prop["rich_text"][0]["plain_text"] if notion_prop["rich_text"] else ""
-            elif prop_type == "select":
-                notion_value = notion_prop["select"]["name"] if notion_prop["select"] else ""
-            elif prop_type == "multi_select":
-                notion_value = (
-                    ",".join([v["name"] for v in notion_prop["multi_select"]])
-                    if notion_prop["multi_select"]
-                    else ""
-                )
-            elif prop_type == "relation":
-                notion_value = (
-                    ",".join([v["id"] for v in notion_prop["relation"]]) if notion_prop["relation"] else ""
-                )
-            elif prop_type == "people":
-                notion_value = ",".join([v["id"] for v in notion_prop["people"]]) if notion_prop["people"] else ""
-            # Add other types as needed
+        if extract and notion_prop_name in notion_props:
+            notion_value = extract(notion_props[notion_prop_name])
 
         # Compare values
-        if str(csv_value) != str(notion_value):
+        if str(csv_row[csv_col]) != str(notion_value):
             return False
 
     return True
 
 
-def filter_rows(csv_rows, notion_pages, mapping, composite_keys):
-    notion_pages_by_key = {
-        extract_notion_composite_key(page, mapping, composite_keys): page for page in notion_pages
-    }
-    new_rows = []
-    update_rows = []
-    skip_rows = []
+def filter_rows(
+    csv_rows: Iterable[Dict[str, Any]],
+    notion_pages_by_key: NotionPageIndex,
+    mapping: Dict[str, Any],
+    composite_keys: List[str],
+) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    """CSVの各行を ("new" | "update" | "skip", 行) として逐次振り分ける"""
+    get_key = make_composite_key_getter(composite_keys)
+    plan = compile_compare_plan(mapping)
     for row in csv_rows:
-        row_key = extract_composite_key(row, composite_keys)
+        row_key = get_key(row)
         if row_key not in notion_pages_by_key:
-            new_rows.append(row)
+            yield "new", row
+        elif are_properties_equal(row, notion_pages_by_key[row_key], plan):
+            yield "skip", row
         else:
-            notion_page = notion_pages_by_key[row_key]
-            if are_properties_equal(row, notion_page, mapping):
-                skip_rows.append(row)
-            else:
-                update_rows.append(row)
-    return new_rows, update_rows, skip_rows
+            yield "update", row
+
+
+_CSV_LIST_SPLIT = re.compile(r"\s*,\s*")
+
+
+def _build_title(value: str) -> Optional[Dict[str, Any]]:
+    return {"title": [{"text": {"content": value}}]}
+
+
+def _build_text(value: str) -> Optional[Dict[str, Any]]:
+    return {"rich_text": [{"text": {"content": value}}]}
+
+
+def _build_select(value: str) -> Optional[Dict[str, Any]]:
+    return {"select": {"name": value} if value else None}
+
+
+def _split_csv_list(value: str) -> List[str]:
+    # 分割と前後の空白除去を1回の正規表現分割で行い、空の要素は捨てる
+    return [v for v in _CSV_LIST_SPLIT.split(value.strip()) if v]
+
+
+def _build_multi_select(value: str) -> Optional[Dict[str, Any]]:
+    # カンマ区切りで複数値を受け取る前提
+    return {"multi_select": [{"name": v} for v in _split_csv_list(value)]}
+
+
+def _build_relation(value: str) -> Optional[Dict[str, Any]]:
+    # カンマ区切りでNotionのページIDを受け取る前提
+    return {"relation": [{"id": v} for v in _split_csv_list(value)]}
+
+
+def _build_people(value: str) -> Optional[Dict[str, Any]]:
+    # カンマ区切りでユーザーIDを受け取る前提
+    return {"people": [{"id": v} for v in _split_csv_list(value)]}
+
+
+def _build_last_edited_by(value: str) -> Optional[Dict[str, Any]]:
+    # 通常自動。明示的に指定したい場合のみ
+    return {"last_edited_by": {"id": value}} if value else None
+
+
+def _build_last_edited_time(value: str) -> Optional[Dict[str, Any]]:
+    # 通常自動。明示的に指定したい場合のみ
+    return {"last_edited_time": value} if value else None
 
 
-def make_notion_payload(row: Dict[str, Any], mapping: Dict[str, Any]) -> Dict[str, Any]:
+# マッピングの型ごとに、CSVの値からNotionプロパティを組み立てる関数 (Noneを返した列は送らない)
+_PAYLOAD_BUILDERS: Dict[str, Callable[[str], Optional[Dict[str, Any]]]] = {
+    "title": _build_title,
+    "text": _build_text,
+    "select": _build_select,
+    "multi_select": _build_multi_select,
+    "relation": _build_relation,
+    "people": _build_people,
+    "last_edited_by": _build_last_edited_by,
+    "last_edited_time": _build_last_edited_time,
+}
+
+PayloadPlan = List[Tuple[str, str, Callable[[str], Optional[Dict[str, Any]]]]]
+
+
+def compile_payload_plan(mapping: Dict[str, Any]) -> PayloadPlan:
+    """マッピングを (CSV列名, Notionプロパティ名, 組み立て関数) のリストに変換する (未対応の型は除外)"""
+    return [
+        (csv_col, mapinfo["notion"], _PAYLOAD_BUILDERS[mapinfo["type"]])
+        for csv_col, mapinfo in mapping.items()
+        if mapinfo["type"] in _PAYLOAD_BUILDERS
+    ]
+
+
+def make_notion_payload(row: Dict[str, Any], plan: PayloadPlan) -> Dict[str, Any]:
     props = {}
-    for csv_col, mapinfo in mapping.items():
-        notion_prop = mapinfo["notion"]
-        typ = mapinfo["type"]
-        value = row[csv_col]
-        if typ == "title":
-            props[notion_prop] = {"title": [{"text": {"content": value}}]}
-        elif typ == "text":
-            props[notion_prop] = {"rich_text": [{"text": {"content": value}}]}
-        elif typ == "select":
-            if value:
-                props[notion_prop] = {"select": {"name": value}}
-            else:
-                props[notion_prop] = {"select": None}
-        elif typ == "multi_select":
-            # カンマ区切りで複数値を受け取る前提
-            values = [v.strip() for v in value.split(",") if v.strip()]
-            props[notion_prop] = {"multi_select": [{"name": v} for v in values]}
-        elif typ == "relation":
-            # カンマ区切りでNotionのページIDを受け取る前提
-            ids = [v.strip() for v in value.split(",") if v.strip()]
-            props[notion_prop] = {"relation": [{"id": v} for v in ids]}
-        elif typ == "people":
-            # カンマ区切りでユーザーIDを受け取る前提
-            ids = [v.strip() for v in value.split(",") if v.strip()]
-            props[notion_prop] = {"people": [{"id": v} for v in ids]}
-        elif typ == "last_edited_by":
-            # 通常自動。明示的に指定したい場合のみ
-            if value:
-                props[notion_prop] = {"last_edited_by": {"id": value}}
-        elif typ == "last_edited_time":
-            # 通常自動。明示的に指定したい場合のみ
-            if value:
-                props[notion_prop] = {"last_edited_time": value}
+    for csv_col, notion_prop, build in plan:
+        prop = build(row[csv_col])
+        if prop is not None:
+            props[notion_prop] = prop
     return {"parent": {"database_id": config.NOTION_DATABASE_ID}, "properties": props}
 
 
-def register_to_notion(rows: List[Dict[str, Any]], mapping: Dict[str, Any]):
-    url = f"{config.NOTION_API_URL}/pages"
-    headers = {
-        "Authorization": f"Bearer {config.NOTION_API_KEY}",
-        "Notion-Version": config.NOTION_API_VERSION,
-        "Content-Type": "application/json",
-    }
-    for row in rows:
-        payload = make_notion_payload(row, mapping)
-        while True:
-            resp = requests.post(url, headers=headers, json=payload)
-            if resp.status_code == 200:
-                print(f"[OK] Registered: {extract_composite_key(row, config.COMPOSITE_KEY)}")
-                break
-            elif resp.status_code == 429:
-                retry_after = int(resp.headers.get("Retry-After", 1))
-                print(f"[WARN] Rate limited. Retrying after {retry_after} seconds.")
-                time.sleep(retry_after)
-            else:
-                print(f"[ERR] Failed: {extract_composite_key(row, config.COMPOSITE_KEY)} -> {resp.text}")
-                break
+def _display_key(row: Dict[str, Any], composite_keys: List[str]) -> str:
+    return format_composite_key(extract_composite_key(row, composite_keys))
+
+
+def _register_row(url: str, row: Dict[str, Any], plan: PayloadPlan, composite_keys: List[str]) -> str:
+    payload = make_notion_payload(row, plan)
+    try:
+        # ページ作成は冪等でないため、処理済みかもしれない5xxや送信後の通信エラーはリトライしない
+        _request_with_backoff("POST", url, idempotent=False, json=payload)
+    except NotionAPIError as e:
+        logger.error("[ERR] Failed: %s -> %s", _display_key(row, composite_keys), e)
+        return "failed"
+    # ログ出力しない通常時は表示用の複合キーを組み立てない
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("[OK] Registered: %s", _display_key(row, composite_keys))
+    return "registered"
 
 
-def update_notion(
-    update_rows: List[Dict[str, Any]],
-    notion_pages: List[Dict[str, Any]],
+def _update_row(
+    url: str,
+    row: Dict[str, Any],
+    notion_pages_by_key: NotionPageIndex,
+    plan: PayloadPlan,
+    composite_keys: List[str],
+) -> str:
+    row_key = extract_composite_key(row, composite_keys)
+    page = notion_pages_by_key.get(row_key)
+    if not page:
+        logger.error("[ERR] Page ID not found: %s", format_composite_key(row_key))
+        return "failed"
+    page_id = page["id"]
+
+    payload = make_notion_payload(row, plan)
+    try:
+        _request_with_backoff("PATCH", f"{url}/{page_id}", json=payload)
+    except NotionAPIError as e:
+        logger.error("[ERR] Failed to update: %s -> %s", format_composite_key(row_key), e)
+        return "failed"
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("[OK] Updated: %s", format_composite_key(row_key))
+    return "updated"
+
+
+def _log_skip(row: Dict[str, Any], composite_keys: List[str]):
+    # 差分なしの行は件数が多くなりがちなので、-v指定時のみ1行ずつ出力する
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("[SKIP] Properties match: %s", _display_key(row, composite_keys))
+
+
+def sync_to_notion(
+    actions: Iterable[Tuple[str, Dict[str, Any]]],
+    notion_pages_by_key: NotionPageIndex,
     mapping: Dict[str, Any],
     composite_keys: List[str],
 ):
+    """filter_rowsの結果を受け取り、新規行は登録・差分のある行は更新する"""
     url = f"{config.NOTION_API_URL}/pages"
-    headers = {
-        "Authorization": f"Bearer {config.NOTION_API_KEY}",
-        "Notion-Version": config.NOTION_API_VERSION,
-        "Content-Type": "application/json",
-    }
-    for row in update_rows:
-        row_key = extract_composite_key(row, composite_keys)
-        # NotionのページIDを取得
-        page_id = None
-        for page in notion_pages:
-            if extract_notion_composite_key(page, mapping, composite_keys) == row_key:
-                page_id = page["id"]
-                break
-        if not page_id:
-            print(f"[ERR] Page ID not found: {row_key}")
-            continue
-
-        payload = make_notion_payload(row, mapping)
-        while True:
-            resp = requests.patch(f"{url}/{page_id}", headers=headers, json=payload)
-            if resp.status_code == 200:
-                print(f"[OK] Updated: {row_key}")
-                break
-            elif resp.status_code == 429:
-                retry_after = int(resp.headers.get("Retry-After", 1))
-                print(f"[WARN] Rate limited. Retrying after {retry_after} seconds.")
-                time.sleep(retry_after)
-            else:
-                print(f"[ERR] Failed to update: {row_key} -> {resp.text}")
-                break
+    plan = compile_payload_plan(mapping)
+    # 成功した行は1行ずつ出力せず件数だけ数え、PROGRESS_INTERVAL件ごとに進捗を出す (-v指定時は1行ずつ出力)
+    counts = collections.Counter()
+
+    def collect(futures: Iterable[Future]):
+        for future in futures:
+            counts[future.result()] += 1
+            # 失敗した行も含めた処理済み件数 (書き込めた件数は最後のサマリで出す)
+            processed = counts["registered"] + counts["updated"] + counts["failed"]
+            if processed % PROGRESS_INTERVAL == 0:
+                logger.info("[INFO] %d rows processed", processed)
+
+    # I/O待ちが支配的なので、レート制限の範囲内で複数行を並列に処理する。
+    # 未完了のタスク数を抑えて、CSVを先読みしすぎないようにする
+    pending = set()
+    try:
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            for action, row in actions:
+                if action == "skip":
+                    counts["skipped"] += 1
+                    _log_skip(row, composite_keys)
+                    continue
+                if len(pending) >= MAX_PENDING:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(done)
+                if action == "new":
+                    pending.add(executor.submit(_register_row, url, row, plan, composite_keys))
+                else:
+                    pending.add(executor.submit(_update_row, url, row, notion_pages_by_key, plan, composite_keys))
+    finally:
+        # 途中で例外が起きても、投入済みのタスクを回収してそこまでの件数を出力する
+        collect(as_completed(pending))
+        logger.info("[OK] %d rows registered, %d rows updated", counts["registered"], counts["updated"])
+        if counts["failed"]:
+            logger.error("[ERR] %d rows failed", counts["failed"])
+        logger.info("[SKIP] %d rows already match", counts["skipped"])
 
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--csv", required=True, help="CSVファイルのパス")
     parser.add_argument("--dryrun", action="store_true", help="ドライランオプション")
+    parser.add_argument(
+        "--cache", metavar="PATH", help="Notionのページをキャッシュするファイルのパス (前回以降に編集されたページのみ取得する)"
+    )
+    parser.add_argument("-v", "--verbose", action="store_true", help="差分のない行も含めて詳細ログを出力する")
     args = parser.parse_args()
 
+    logging.basicConfig(level=logging.INFO, format="%(message)s", stream=sys.stdout)
+    if args.verbose:
+        logger.setLevel(logging.DEBUG)
+
     # 設定バリデーション
     assert config.NOTION_API_URL and config.NOTION_API_KEY and config.NOTION_DATABASE_ID
     assert isinstance(config.CSV_TO_NOTION_MAPPING, dict)
     assert isinstance(config.COMPOSITE_KEY, list)
 
     csv_rows = load_csv(args.csv, config.COMPOSITE_KEY)
-    notion_pages = get_notion_db_items(config.CSV_TO_NOTION_MAPPING, config.COMPOSITE_KEY)
-    new_rows, update_rows, skip_rows = filter_rows(csv_rows, notion_pages, config.CSV_TO_NOTION_MAPPING, config.COMPOSITE_KEY)
+    # 先頭だけ読んで小さいCSVかどうかを判定する (読んだ行は後で残りの行と連結する)
+    head_rows = list(itertools.islice(csv_rows, TARGETED_QUERY_MAX_ROWS + 1))
+    if args.cache:
+        notion_pages_by_key = get_notion_db_items_cached(
+            args.cache, config.CSV_TO_NOTION_MAPPING, config.COMPOSITE_KEY
+        )
+    elif len(head_rows) <= TARGETED_QUERY_MAX_ROWS and can_query_by_composite_keys(
+        config.CSV_TO_NOTION_MAPPING, config.COMPOSITE_KEY
+    ):
+        notion_pages_by_key = get_notion_db_items_by_keys(
+            head_rows, config.CSV_TO_NOTION_MAPPING, config.COMPOSITE_KEY
+        )
+    else:
+        notion_pages_by_key = get_notion_db_items(config.CSV_TO_NOTION_MAPPING, config.COMPOSITE_KEY)
+    actions = filter_rows(
+        itertools.chain(head_rows, csv_rows), notion_pages_by_key, config.CSV_TO_NOTION_MAPPING, config.COMPOSITE_KEY
+    )
 
     if not args.dryrun:
-        register_to_notion(new_rows, config.CSV_TO_NOTION_MAPPING)
-        update_notion(update_rows, notion_pages, config.CSV_TO_NOTION_MAPPING, config.COMPOSITE_KEY)
+        sync_to_notion(actions, notion_pages_by_key, config.CSV_TO_NOTION_MAPPING, config.COMPOSITE_KEY)
     else:
-        print("ドライランモードのため、Notion APIへの登録・更新はスキップします")
-
-    for row in skip_rows:
-        print(f"[SKIP] Properties match: {extract_composite_key(row, config.COMPOSITE_KEY)}")
-
-    print("完了")
+        logger.info("ドライランモードのため、Notion APIへの登録・更新はスキップします")
+        skipped = 0
+        for action, row in actions:
+            if action == "skip":
+                skipped += 1
+                _log_skip(row, config.COMPOSITE_KEY)
+        logger.info("[SKIP] %d rows already match", skipped)
+
+    logger.info("完了")
 
 
 if __name__ == "__main__":